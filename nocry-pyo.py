@@ -9,6 +9,11 @@ import sys
 # import termios
 import tty
 import select
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import soundfile as sf
 from pyo import *
 from pythonosc.udp_client import SimpleUDPClient
 
@@ -45,8 +50,201 @@ MIDI_DEVICE_FILTER = config.get("MIDI_DEVICE_FILTER", "")
 midi_connected = False
 midi_device_index = -1
 
+ANALYSIS_CACHE = config.get("ANALYSIS_CACHE", os.path.join(os.path.dirname(os.path.abspath(CONFIG_FILE)), "analysis_cache.json"))
+ONSET_THRESHOLD_DB = config.get("ONSET_THRESHOLD_DB", -50.0)   # dB relative to the file peak, first sample above this is the onset
+NORMALIZE_LUFS = config.get("NORMALIZE_LUFS", -16.0)           # target loudness, null to disable normalization
+PEAK_CEILING_DB = config.get("PEAK_CEILING_DB", -1.0)          # normalization gain never pushes peak above this
+MAX_GAIN_DB = config.get("MAX_GAIN_DB", 12.0)                  # normalization never boosts more than this
+ANALYSIS_WORKERS = config.get("ANALYSIS_WORKERS", 2)           # processes used by the startup analysis pass
+
 RUN = True
 
+# ---- SAMPLE ANALYSIS ----
+# The startup pass runs before the audio server is booted, so the worker
+# processes are forked before pyo starts any audio or MIDI threads.
+
+ANALYSIS_VERSION = 3   # bump when analyze_file() results change
+ONSET_PREROLL = 0.002  # seconds kept before the detected onset to preserve the attack
+ANALYSIS_PARAMS = {"version": ANALYSIS_VERSION, "onset_db": ONSET_THRESHOLD_DB, "preroll": ONSET_PREROLL}
+
+def db(x):
+    return float(20.0 * np.log10(max(x, 1e-10)))
+
+def analyze_file(filename):
+    sr = sf.info(filename).samplerate
+    hop = max(1, int(0.1 * sr))         # 100ms power slices
+    blocksize = hop * 50
+
+    # Stream the file in blocks (a whole number of hops) so memory stays flat
+    peak = 0.0
+    frames = 0
+    total_power = 0.0
+    hop_power = []
+    for data in sf.blocks(filename, blocksize=blocksize, dtype='float32', always_2d=True):
+        peak = max(peak, float(np.abs(data).max()))
+
+        # Power per frame, channels summed like BS.1770
+        power = np.square(data, dtype=np.float64).sum(axis=1)
+        total_power += float(power.sum())
+        hop_power.append(np.add.reduceat(power, np.arange(0, len(power), hop)))
+        frames += len(power)
+
+    # Onset: first frame above a threshold relative to the peak, so quiet
+    # files are not trimmed into their attack. Second pass stops at the hit.
+    threshold = peak * 10 ** (ONSET_THRESHOLD_DB / 20.0)
+    onset = 0
+    read = 0
+    if peak > 0.0:
+        for data in sf.blocks(filename, blocksize=blocksize, dtype='float32', always_2d=True):
+            above = np.abs(data).max(axis=1) > threshold
+            if above.any():
+                onset = read + int(np.argmax(above))
+                break
+            read += len(data)
+    onset = max(0, onset - int(ONSET_PREROLL * sr))
+    rms = np.sqrt(total_power / frames) if frames else 0.0
+
+    # LUFS-style gated loudness: 400ms blocks, 75% overlap, -70 absolute / -10 relative gates.
+    # No K-weighting filter, so this is an unweighted approximation of integrated loudness.
+    hop_power = np.concatenate(hop_power) if hop_power else np.zeros(0)
+    full_hops = frames // hop
+    if full_hops >= 4:
+        csum = np.concatenate(([0.0], np.cumsum(hop_power[:full_hops])))
+        ms = (csum[4:] - csum[:-4]) / (4 * hop)
+    else:
+        ms = np.array([total_power / frames]) if frames else np.array([0.0])
+    lk = -0.691 + 10.0 * np.log10(np.maximum(ms, 1e-20))
+    gated = ms[lk > -70.0]
+    if len(gated):
+        rel = -0.691 + 10.0 * np.log10(gated.mean()) - 10.0
+        gated = ms[(lk > -70.0) & (lk > rel)]
+    lufs = float(-0.691 + 10.0 * np.log10(gated.mean())) if len(gated) else None
+
+    return {
+        "onset": onset / sr,
+        "peak_db": db(peak),
+        "rms_db": db(rms),
+        "lufs": lufs,
+    }
+
+def normalization_gain(stats):
+    if NORMALIZE_LUFS is None or stats is None or stats.get("lufs") is None:
+        return 1.0
+    gain_db = min(NORMALIZE_LUFS - stats["lufs"], PEAK_CEILING_DB - stats["peak_db"], MAX_GAIN_DB)
+    return 10 ** (gain_db / 20.0)
+
+def load_analysis_cache():
+    try:
+        with open(ANALYSIS_CACHE, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # Results computed with other analysis settings are stale
+    if cache.get("params") != ANALYSIS_PARAMS:
+        return {}
+    return cache.get("files", {})
+
+cache_lock = threading.Lock()
+
+def save_analysis_cache():
+    with cache_lock:
+        # Write then rename, so a power cut never leaves a truncated cache
+        tmp = ANALYSIS_CACHE + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"params": ANALYSIS_PARAMS, "files": dict(analysis_cache)}, f)
+            os.replace(tmp, ANALYSIS_CACHE)
+        except OSError as e:
+            print(f"WARNING: Could not write analysis cache {ANALYSIS_CACHE}: {e}")
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return {"mtime": st.st_mtime, "size": st.st_size}
+
+def is_cached(filename, signature):
+    entry = analysis_cache.get(filename)
+    return entry is not None and entry.get("mtime") == signature["mtime"] and entry.get("size") == signature["size"]
+
+def safe_analyze(filename):
+    try:
+        return analyze_file(filename)
+    except Exception as e:
+        print(f"WARNING: Could not analyze {filename}: {e}")
+        return {"error": True}  # cached too, so broken files are not retried on every trigger
+
+def store_analysis(filename, signature, stats):
+    stats.update(signature)
+    analysis_cache[filename] = stats
+
+ANALYSIS_SAVE_EVERY = 20  # results between cache saves during the startup pass
+
+def analyze_library(folders):
+    # Optional pass: any failure here must not keep the sampler from starting.
+    # Files it misses are picked up lazily by get_analysis().
+    files = []
+    for folder in folders:
+        for f in glob.glob(os.path.join(folder, "**", "*.wav"), recursive=True):
+            try:
+                signature = file_signature(f)
+            except OSError as e:  # dangling symlink, stick pulled during the scan...
+                print(f"WARNING: Could not stat {f}: {e}")
+                continue
+            if not is_cached(f, signature):
+                files.append((f, signature))
+    if not files:
+        return
+    print(f"Analyzing {len(files)} samples...")
+    done = 0
+    try:
+        # Fork explicitly: spawn/forkserver would re-run this whole script in each worker
+        with ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, mp_context=multiprocessing.get_context("fork")) as pool:
+            futures = {pool.submit(safe_analyze, f): (f, signature) for f, signature in files}
+            for future in as_completed(futures):
+                filename, signature = futures[future]
+                store_analysis(filename, signature, future.result())
+                done += 1
+                if done % ANALYSIS_SAVE_EVERY == 0:
+                    save_analysis_cache()
+    except Exception as e:
+        print(f"WARNING: Sample analysis aborted after {done}/{len(files)} files: {e}")
+    finally:
+        save_analysis_cache()
+
+# Files not analyzed by the startup pass (new files, USB mounted late) are
+# analyzed in the background; they play untrimmed at unity gain until then.
+analysis_queue = queue.Queue()
+analysis_pending = set()
+
+def analysis_worker():
+    while True:
+        filename = analysis_queue.get()
+        try:
+            signature = file_signature(filename)
+            if not is_cached(filename, signature):
+                store_analysis(filename, signature, safe_analyze(filename))
+                save_analysis_cache()
+        except OSError as e:
+            print(f"WARNING: Could not analyze {filename}: {e}")
+        finally:
+            analysis_pending.discard(filename)
+
+def get_analysis(filename):
+    # Checked against the file on every trigger: a swapped stick can reuse paths
+    try:
+        signature = file_signature(filename)
+    except OSError:
+        return None
+    if is_cached(filename, signature):
+        return analysis_cache[filename]
+    if filename not in analysis_pending:
+        analysis_pending.add(filename)
+        analysis_queue.put(filename)
+    return None
+
+analysis_cache = load_analysis_cache()  # results keyed by path, validated by mtime and size
+analyze_library([LOOPS_PATH, ONESHOTS_PATH])
+threading.Thread(target=analysis_worker, daemon=True).start()
+
 # ---- AUDIO SERVER ----
 
 # Replace your current Server setup with this:
@@ -129,6 +327,16 @@ def resolve_files(folder, pattern):
         print(f"WARNING: No files found for pattern {search_path}")
     return files
 
+def make_player(filename, loop, volume, trim=True):
+    stats = get_analysis(filename)
+    # SfPlayer wraps back to the offset on every loop cycle, so trimming a loop shortens it
+    onset = stats.get("onset", 0.0) if stats and trim else 0.0
+    gain = normalization_gain(stats)
+    p = SfPlayer(filename, speed=1, loop=loop, offset=onset, mul=volume * gain).out()
+    p.filename = filename  # Attach filename for comparison
+    p.gain = gain          # Per-file normalization gain, applied on top of volume
+    return p
+
 
 # ---- LOOPS ----
 
@@ -166,8 +374,7 @@ def play_loop(files, key, rewind_on_retrigger=False):
         stop_looper()
     
     # Start new player
-    player = SfPlayer(filename, speed=1, loop=True, mul=looper_volume).out()
-    player.filename = filename  # Attach filename for comparison
+    player = make_player(filename, True, looper_volume, trim=LOOPS.get("trim", False))
     active_loopers[key] = player
     
     
@@ -206,8 +413,7 @@ def play_oneshot(files, key, poly=False):
                 oldest.stop()
                 active_oneshot_poly.remove(oldest)
             # Start new voice
-            p = SfPlayer(filename, speed=1, loop=False, mul=oneshots_volume).out()
-            p.filename = filename  # Attach filename for comparison
+            p = make_player(filename, False, oneshots_volume)
             active_oneshot_poly.append(p)
         else:
             # Stop all oneshots (poly and mono)
@@ -219,8 +425,7 @@ def play_oneshot(files, key, poly=False):
                 p.stop()
                 del active_oneshots[k]
             # Start new monophonic oneshot
-            p = SfPlayer(filename, speed=1, loop=False, mul=oneshots_volume).out()
-            p.filename = filename
+            p = make_player(filename, False, oneshots_volume)
             active_oneshots[key] = p
     else:
         if poly:
@@ -229,8 +434,7 @@ def play_oneshot(files, key, poly=False):
             if len(active_oneshot_poly) >= POLYPHONY:
                 oldest = active_oneshot_poly.pop(0)
                 oldest.stop()
-            p = SfPlayer(filename, speed=1, loop=False, mul=oneshots_volume).out()
-            p.filename = filename
+            p = make_player(filename, False, oneshots_volume)
             active_oneshot_poly.append(p)
         else:
             # Monophonic: stop only other instances of this file
@@ -246,8 +450,7 @@ def play_oneshot(files, key, poly=False):
                     p.stop()
                     active_oneshot_poly.remove(p)
             # Start new monophonic oneshot
-            p = SfPlayer(filename, speed=1, loop=False, mul=oneshots_volume).out()
-            p.filename = filename
+            p = make_player(filename, False, oneshots_volume)
             active_oneshots[key] = p
             
 
@@ -281,7 +484,7 @@ def handle_loop_event(event_type, num, info):
         global looper_volume
         looper_volume = info.get("value", 127) / 127.0
         for key in list(active_loopers.keys()):
-            active_loopers[key].setMul(looper_volume)
+            active_loopers[key].setMul(looper_volume * active_loopers[key].gain)
         return
     
     files = resolve_files(LOOPS_PATH, pattern)
@@ -300,9 +503,9 @@ def handle_oneshot_event(event_type, num, info):
         global oneshots_volume
         oneshots_volume = info.get("value", 127) / 127.0
         for key, player in active_oneshots.items():
-            player.setMul(oneshots_volume)
+            player.setMul(oneshots_volume * player.gain)
         for player in active_oneshot_poly:
-            player.setMul(oneshots_volume)
+            player.setMul(oneshots_volume * player.gain)
         return
     
     files = resolve_files(ONESHOTS_PATH, pattern)